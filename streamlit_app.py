@@ -1,6 +1,21 @@
 import streamlit as st
+import sys
 import pandas as pd
+import polars as pl
+import numpy as np
 import io
+from functools import reduce
+from operator import or_
+from collections import namedtuple
+
+# Shared by every result without missing ingredients; must never be mutated
+EMPTY_MISSING = {}
+
+# One scored product: counts are computed during scoring so downstream
+# consumers never rescan the exploded set
+Result = namedtuple(
+    'Result', ['mask', 'batch_id', 'ratio', 'missing_sources',
+               'available_count', 'total_count'])
 
 # Set page config
 st.set_page_config(page_title="Formula Feasibility Checker", layout="wide")
@@ -20,93 +35,306 @@ history_file = st.sidebar.file_uploader(
 
 
 def normalize_code(series):
-    """Ensures codes are treated as strings to avoid TypeErrors."""
-    return series.astype(str).str.strip()
-
-
-def get_best_recipe_path(product_code, variants_map, stock_set, memo=None, path=None):
+    """Ensures codes are treated as strings to avoid TypeErrors.
+    One plain-Python strip+intern pass beats the .str accessor (which
+    allocates an intermediate Series per step) on these code columns,
+    and interning makes the many later dict/set lookups pointer-fast."""
+    codes = series.astype(str).to_numpy(dtype=object).tolist()
+    # astype(str) leaves NaN as float; keep it that way so dropna still works
+    return pd.Series([sys.intern(c.strip()) if isinstance(c, str) else c
+                      for c in codes],
+                     index=series.index)
+
+
+@st.cache_data(show_spinner=False)
+def load_target(file_bytes):
+    """Parses the target workbook. Cached on the raw file bytes, so
+    re-running the analysis on unchanged uploads skips the parse."""
+    df = pl.read_excel(
+        io.BytesIO(file_bytes), engine="calamine",
+        read_options={"use_columns": "A:D"}).to_pandas()
+    df.columns = ['Product Code', 'Product Desc', 'Yearly Qty', '3M Qty']
+    return df
+
+
+@st.cache_data(show_spinner=False)
+def load_stock(file_bytes):
+    """Parses the stock workbook (cached on the raw file bytes)."""
+    df = pl.read_excel(
+        io.BytesIO(file_bytes), engine="calamine",
+        read_options={"use_columns": "D,I"}).to_pandas()
+    df.columns = ['RM Code', 'RM Desc']
+    return df
+
+
+@st.cache_data(show_spinner=False)
+def load_history(file_bytes):
+    """Parses the weighing-history workbook (cached on the raw file bytes)."""
+    # History: A=RM, B=Desc, D=Batch, J=Parent, K=Desc
+    df = pl.read_excel(
+        io.BytesIO(file_bytes), engine="calamine",
+        read_options={"use_columns": "A,B,D,J:K"}).to_pandas()
+    df.columns = ['RM Code', 'RM Desc', 'Batch ID', 'Parent Code', 'Parent Desc']
+    return df
+
+
+@st.cache_data(show_spinner=False)
+def build_lookups(stock_bytes, history_bytes):
     """
-    Recursively finds the BEST historical version.
-    Returns: (Set of Exploded Ingredients, BatchID Used, Availability Score, Missing Sources Dict)
+    Cleans stock/history and derives the structures the analysis needs:
+    (variants_map, stock_set, desc_map). Cached on the two byte-blobs so
+    follow-up runs with the same files are near-instant.
     """
-    if memo is None:
-        memo = {}
-    if path is None:
-        path = set()
-
-    # Check Cache
-    if product_code in memo:
-        return memo[product_code]
-
-    # Check Circular
-    if product_code in path:
-        return (set(), "Circular Ref", 0.0, {})
-
-    # Base Case: Raw Material (or Product with no history)
-    if product_code not in variants_map:
-        is_in_stock = product_code in stock_set
-        # If missing, source is itself ("Direct")
-        missing_src = {} if is_in_stock else {product_code: "Direct"}
-        return ({product_code}, "Raw Material", 1.0 if is_in_stock else 0.0, missing_src)
-
-    # Recursive Search
-    possible_batches = variants_map[product_code]
-
-    best_result = None
-    best_score = -1.0
-    best_len = -1
-
-    path.add(product_code)
-
-    for batch_id, ingredients in possible_batches:
-        current_exploded_rms = set()
-        current_missing_sources = {}
-
-        # Explode this batch
-        for ing in ingredients:
-            exploded_set, _, _, child_missing_sources = get_best_recipe_path(
-                ing, variants_map, stock_set, memo, path)
-
-            current_exploded_rms.update(exploded_set)
+    df_stock = load_stock(stock_bytes)
+    df_history = load_history(history_bytes)
+
+    # DATA CLEANING
+    df_stock['RM Code'] = normalize_code(df_stock['RM Code'])
+    df_history['RM Code'] = normalize_code(df_history['RM Code'])
+    df_history['Parent Code'] = normalize_code(df_history['Parent Code'])
+    df_history['Batch ID'] = df_history['Batch ID'].astype(str)
+
+    # Clean NaNs and Self-References
+    df_history = df_history.dropna(subset=['RM Code', 'Parent Code'])
+    df_history = df_history[df_history['RM Code']
+                            != df_history['Parent Code']]
+
+    # Build Dictionary for Descriptions
+    # We need descriptions for Ingredients AND Intermediates (Parents)
+    # dict(zip(...)) skips the intermediate Series construction; like
+    # Series.to_dict(), later duplicates win
+    desc_map = dict(zip(df_history['RM Code'].to_numpy().tolist(),
+                        df_history['RM Desc'].to_numpy().tolist()))
+    desc_map |= dict(zip(df_stock['RM Code'].to_numpy().tolist(),
+                         df_stock['RM Desc'].to_numpy().tolist()))
+    desc_map |= dict(zip(df_history['Parent Code'].to_numpy().tolist(),
+                         df_history['Parent Desc'].to_numpy().tolist()))
+
+    stock_set = set(df_stock['RM Code'].unique())
+
+    # BUILD VARIANTS MAP
+    # One stable sort + run-boundary sweep instead of nested groupby
+    df_h = df_history[['Parent Code', 'Batch ID', 'RM Code']].sort_values(
+        ['Parent Code', 'Batch ID'], kind='stable')
+    pc = df_h['Parent Code'].to_numpy()
+    bi = df_h['Batch ID'].to_numpy()
+    rm = df_h['RM Code'].to_numpy()
+
+    variants_map = {}
+    if len(pc) > 0:
+        # Row indices where a new (parent, batch) run begins
+        starts = np.flatnonzero(
+            np.r_[True, (pc[1:] != pc[:-1]) | (bi[1:] != bi[:-1])])
+        bounds = np.r_[starts, len(pc)]
+        for s, e in zip(bounds[:-1], bounds[1:]):
+            variants_map.setdefault(pc[s], []).append(
+                (bi[s], rm[s:e].tolist()))
+
+    # Weighing history often repeats the same ingredient list across many
+    # batches; score one representative per distinct recipe. Keeping the
+    # first batch matches the tie-breaker (identical sets score identically,
+    # earliest wins)
+    for parent, batches in variants_map.items():
+        if len(batches) > 1:
+            seen = {}
+            for batch_id, ingredients in batches:
+                seen.setdefault(frozenset(ingredients), (batch_id, ingredients))
+            if len(seen) < len(batches):
+                variants_map[parent] = list(seen.values())
+
+    return variants_map, stock_set, desc_map
+
+
+def find_sccs(all_nodes, adjacency):
+    """
+    Iterative Tarjan (explicit stack, no Python recursion).
+    Returns SCCs in reverse-topological order: ingredients before parents.
+    """
+    counter = 0
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    sccs = []
+
+    for start in all_nodes:
+        if start in index:
+            continue
+
+        index[start] = lowlink[start] = counter
+        counter += 1
+        stack.append(start)
+        on_stack.add(start)
+        work = [(start, iter(adjacency.get(start, ())))]
+
+        while work:
+            node, children = work[-1]
+
+            descended = False
+            for child in children:
+                if child not in index:
+                    # Descend into unvisited child
+                    index[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(adjacency.get(child, ()))))
+                    descended = True
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+
+            if descended:
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+            if lowlink[node] == index[node]:
+                # node is the root of an SCC
+                scc = []
+                while True:
+                    member = stack.pop()
+                    on_stack.remove(member)
+                    scc.append(member)
+                    if member == node:
+                        break
+                sccs.append(scc)
+
+    return sccs
+
+
+def compute_all(variants_map, stock_set, extra_codes=(), on_progress=None):
+    """
+    Evaluates every product bottom-up (reverse-topological order) and
+    picks the BEST historical version for each, in a single linear sweep.
+    Exploded ingredient sets are integer bitmasks (one bit per RM code),
+    so unions and availability counts are C-level big-int operations.
+    on_progress (a 0.0-1.0 callable) is invoked at most ~100 times over
+    the sweep, so per-node UI round-trips never dominate the runtime.
+    Returns: (dict of code -> Result, id_to_code list, stock bitmask)
+    """
+    # Collect every code that appears anywhere (parents, ingredients, targets)
+    all_nodes = set(variants_map)
+    for variants in variants_map.values():
+        for _, ingredients in variants:
+            all_nodes.update(ingredients)
+    all_nodes.update(extra_codes)
+
+    # Assign each code a stable integer ID; bit i of a mask = code id_to_code[i]
+    id_to_code = sorted(all_nodes)
+    rm_id = {code: i for i, code in enumerate(id_to_code)}
+    stock_mask = reduce(
+        or_, (1 << rm_id[c] for c in stock_set if c in rm_id), 0)
+
+    # Parent -> deduplicated ingredient list (edges of the DAG)
+    adjacency = {}
+    for parent, variants in variants_map.items():
+        seen = set()
+        children = []
+        for _, ingredients in variants:
+            for ing in ingredients:
+                if ing not in seen:
+                    seen.add(ing)
+                    children.append(ing)
+        adjacency[parent] = children
+
+    results = {}
+
+    sccs = find_sccs(all_nodes, adjacency)
+    total_sccs = len(sccs)
+    prog_step = max(1, total_sccs // 100)
+
+    for i, scc in enumerate(sccs):
+        if on_progress is not None and (i + 1) % prog_step == 0:
+            on_progress((i + 1) / total_sccs)
+
+        if len(scc) > 1 or scc[0] in adjacency.get(scc[0], ()):
+            # Circular reference (incl. self-loops): members are unresolvable
+            for node in scc:
+                results[node] = Result(0, "Circular Ref", 0.0,
+                                       EMPTY_MISSING, 0, 0)
+            continue
+
+        node = scc[0]
+
+        # Base Case: Raw Material (or Product with no history)
+        if node not in variants_map:
+            is_in_stock = node in stock_set
+            # If missing, source is itself ("Direct")
+            missing_src = EMPTY_MISSING if is_in_stock else {node: "Direct"}
+            results[node] = Result(1 << rm_id[node], "Raw Material",
+                                   1.0 if is_in_stock else 0.0, missing_src,
+                                   1 if is_in_stock else 0, 1)
+            continue
+
+        variants = variants_map[node]
+
+        if not variants:
+            missing_src = {node: "Direct"}
+            node_mask = 1 << rm_id[node]
+            results[node] = Result(node_mask, "No Valid Recipe", 0.0,
+                                   missing_src,
+                                   (node_mask & stock_mask).bit_count(), 1)
+            continue
+
+        # Explode every batch (children are already computed), then pick
+        # the winner with one vectorized argmax instead of branchy Python
+        # compares: highest ratio first, then most ingredients, with the
+        # earliest batch winning exact ties (lexsort is stable)
+        batch_masks = [
+            reduce(or_, (results[ing].mask for ing in ingredients), 0)
+            for _, ingredients in variants]
+        n_batches = len(batch_masks)
+        totals = np.fromiter((m.bit_count() for m in batch_masks),
+                             dtype=np.int64, count=n_batches)
+        avails = np.fromiter(
+            ((m & stock_mask).bit_count() for m in batch_masks),
+            dtype=np.int64, count=n_batches)
+        ratios = avails / np.maximum(totals, 1)
+        best_idx = int(np.lexsort((-totals, -ratios))[0])
+
+        # Missing Sources tracking, only for the winning batch
+        best_batch_id, best_ingredients = variants[best_idx]
+        current_missing_sources = EMPTY_MISSING
+        owns_missing = False
+
+        for ing in best_ingredients:
+            child_missing_sources = results[ing].missing_sources
+
+            if not child_missing_sources:
+                continue
+
+            # "Direct" only ever appears as the sole entry of a leaf /
+            # no-recipe result, keyed by the child itself
+            needs_remap = child_missing_sources.get(ing) == "Direct"
+
+            if not owns_missing:
+                if not needs_remap and not current_missing_sources:
+                    # First contributor needs no rewriting: share its
+                    # dict by reference instead of copying it
+                    current_missing_sources = child_missing_sources
+                    continue
+                # Copy-on-write before the first real merge
+                current_missing_sources = dict(current_missing_sources)
+                owns_missing = True
 
-            # Update Missing Sources tracking
             for missing_rm, source in child_missing_sources.items():
                 if source == "Direct":
-                    # The ingredient 'ing' is the missing item inside 'product_code'
-                    current_missing_sources[missing_rm] = product_code
+                    # The ingredient 'ing' is the missing item inside 'node'
+                    current_missing_sources[missing_rm] = node
                 else:
                     # Keep the deeper source (preserve the original parent)
                     current_missing_sources[missing_rm] = source
 
-        # Calculate Score
-        all_rms = list(current_exploded_rms)
-        available_rms = [rm for rm in all_rms if rm in stock_set]
-        total_count = len(all_rms)
-
-        ratio = (len(available_rms) / total_count) if total_count > 0 else 0.0
-
-        # Tie-Breaker Logic (Prefer higher ratio, then more complex formulas)
-        is_better = False
-        if ratio > best_score:
-            is_better = True
-        elif ratio == best_score:
-            if total_count > best_len:
-                is_better = True
-
-        if is_better:
-            best_score = ratio
-            best_len = total_count
-            best_result = (current_exploded_rms, batch_id,
-                           ratio, current_missing_sources)
-
-    path.remove(product_code)
-
-    if best_result is None:
-        missing_src = {product_code: "Direct"}
-        best_result = ({product_code}, "No Valid Recipe", 0.0, missing_src)
+        results[node] = Result(batch_masks[best_idx], best_batch_id,
+                               float(ratios[best_idx]),
+                               current_missing_sources,
+                               int(avails[best_idx]), int(totals[best_idx]))
 
-    memo[product_code] = best_result
-    return best_result
+    return results, id_to_code, stock_mask
 
 # --- MAIN PROCESS ---
 
@@ -115,83 +343,47 @@ if target_file and stock_file and history_file:
     if st.button("Run Analysis"):
         with st.spinner("Analyzing recursive structures..."):
             try:
-                # 1. READ FILES
-                df_target = pd.read_excel(target_file, usecols="A:D", header=0)
-                df_target.columns = ['Product Code',
-                                     'Product Desc', 'Yearly Qty', '3M Qty']
-
-                df_stock = pd.read_excel(stock_file, usecols="D,I", header=0)
-                df_stock.columns = ['RM Code', 'RM Desc']
-
-                # History: A=RM, B=Desc, D=Batch, J=Parent, K=Desc
-                df_history = pd.read_excel(history_file, usecols=[
-                                           0, 1, 3, 9, 10], header=0)
-                df_history.columns = ['RM Code', 'RM Desc',
-                                      'Batch ID', 'Parent Code', 'Parent Desc']
-
-                # 2. DATA CLEANING
+                # 1. READ FILES (cached; unchanged uploads skip the parse)
+                df_target = load_target(target_file.getvalue())
                 df_target['Product Code'] = normalize_code(
                     df_target['Product Code'])
-                df_stock['RM Code'] = normalize_code(df_stock['RM Code'])
-                df_history['RM Code'] = normalize_code(df_history['RM Code'])
-                df_history['Parent Code'] = normalize_code(
-                    df_history['Parent Code'])
-                df_history['Batch ID'] = df_history['Batch ID'].astype(str)
-
-                # Clean NaNs and Self-References
-                df_history = df_history.dropna(
-                    subset=['RM Code', 'Parent Code'])
-                df_history = df_history[df_history['RM Code']
-                                        != df_history['Parent Code']]
-
-                # Build Dictionary for Descriptions
-                # We need descriptions for Ingredients AND Intermediates (Parents)
-                desc_map = pd.Series(
-                    df_history['RM Desc'].values, index=df_history['RM Code']).to_dict()
-                desc_map.update(
-                    pd.Series(df_stock['RM Desc'].values, index=df_stock['RM Code']).to_dict())
-                desc_map.update(pd.Series(
-                    df_history['Parent Desc'].values, index=df_history['Parent Code']).to_dict())
-
-                stock_set = set(df_stock['RM Code'].unique())
-
-                # 3. BUILD VARIANTS MAP
-                variants_map = {}
-                grouped = df_history.groupby('Parent Code')
-                for parent, group in grouped:
-                    batch_groups = group.groupby('Batch ID')
-                    variants_list = []
-                    for batch_id, batch_rows in batch_groups:
-                        ingredients = batch_rows['RM Code'].tolist()
-                        if len(ingredients) > 0:
-                            variants_list.append((batch_id, ingredients))
-                    variants_map[parent] = variants_list
-
-                # 4. ANALYZE TARGETS
-                results = []
-                memo_cache = {}
-                prog_bar = st.progress(0)
-                total_rows = len(df_target)
+                # Blank cells survive normalize_code as NaN; drop them so
+                # mixed float/str codes never reach the analysis
+                df_target = df_target.dropna(subset=['Product Code'])
 
-                for i, (index, row) in enumerate(df_target.iterrows()):
-                    p_code = row['Product Code']
+                # 2. BUILD LOOKUPS (cached on the stock/history byte-blobs)
+                variants_map, stock_set, desc_map = build_lookups(
+                    stock_file.getvalue(), history_file.getvalue())
 
-                    # RUN RECURSION
-                    exploded_rms, best_batch_id, ratio, missing_sources = get_best_recipe_path(
-                        p_code, variants_map, stock_set, memo_cache
-                    )
-
-                    exploded_rms = list(exploded_rms)
-                    num_exploded = len(exploded_rms)
-                    available_rms = [
-                        rm for rm in exploded_rms if rm in stock_set]
-                    num_available = len(available_rms)
-                    num_missing = len(exploded_rms) - num_available
-
-                    # GENERATE DETAILED MISSING LIST
+                # 3. ANALYZE TARGETS
+                # One bottom-up pass scores every product exactly once
+                prog_bar = st.progress(0)
+                results_map, id_to_code, stock_mask = compute_all(
+                    variants_map, stock_set, df_target['Product Code'],
+                    on_progress=prog_bar.progress)
+
+                # Build per-product lookup maps once (targets may repeat codes)
+                batch_map = {}
+                exploded_count_map = {}
+                avail_count_map = {}
+                ratio_map = {}
+                missing_list_map = {}
+
+                for p_code in dict.fromkeys(df_target['Product Code'].tolist()):
+                    res = results_map[p_code]
+                    missing_sources = res.missing_sources
+
+                    # GENERATE DETAILED MISSING LIST (decode bits back to
+                    # codes by peeling the lowest set bit; touches only the
+                    # missing bits, not every bit position)
                     missing_details = []
-                    actual_missing_rms = [
-                        rm for rm in exploded_rms if rm not in stock_set]
+                    missing_mask = res.mask & ~stock_mask
+                    actual_missing_rms = []
+                    while missing_mask:
+                        low_bit = missing_mask & -missing_mask
+                        actual_missing_rms.append(
+                            id_to_code[low_bit.bit_length() - 1])
+                        missing_mask ^= low_bit
 
                     for m_code in actual_missing_rms:
                         m_desc = desc_map.get(m_code, "Unknown")
@@ -212,27 +404,33 @@ if target_file and stock_file and history_file:
 
                         missing_details.append(str_entry)
 
+                    batch_map[p_code] = (
+                        res.batch_id if res.batch_id != "Raw Material" else "N/A")
+                    exploded_count_map[p_code] = res.total_count
+                    avail_count_map[p_code] = res.available_count
+                    ratio_map[p_code] = res.ratio
                     # Changed Separator to just ";"
-                    missing_str = ";".join(missing_details)
-                    formula_ref = best_batch_id if best_batch_id != "Raw Material" else "N/A"
-
-                    results.append({
-                        'Product Code': p_code,
-                        'Product Description': row['Product Desc'],
-                        'Yearly Qty': row['Yearly Qty'],
-                        '3M Qty': row['3M Qty'],
-                        'Formula Used (Batch)': formula_ref,
-                        '# Ingredients': num_exploded,
-                        '# Available': num_available,
-                        'Availability Ratio': ratio,
-                        '# Missing': num_missing,
-                        'Missing List': missing_str
-                    })
-
-                    prog_bar.progress((i + 1) / total_rows)
-
-                # 5. EXPORT
-                df_result = pd.DataFrame(results)
+                    missing_list_map[p_code] = ";".join(missing_details)
+
+                # Assemble the whole result table vectorized (no iterrows)
+                target_codes = df_target['Product Code']
+                df_result = pd.DataFrame({
+                    'Product Code': target_codes,
+                    'Product Description': df_target['Product Desc'],
+                    'Yearly Qty': df_target['Yearly Qty'],
+                    '3M Qty': df_target['3M Qty'],
+                    'Formula Used (Batch)': target_codes.map(batch_map),
+                    '# Ingredients': target_codes.map(exploded_count_map),
+                    '# Available': target_codes.map(avail_count_map),
+                    'Availability Ratio': target_codes.map(ratio_map),
+                })
+                df_result['# Missing'] = (
+                    df_result['# Ingredients'] - df_result['# Available'])
+                df_result['Missing List'] = target_codes.map(missing_list_map)
+
+                prog_bar.progress(1.0)
+
+                # 4. EXPORT
 
                 st.dataframe(df_result.head(10).style.format(
                     {'Availability Ratio': "{:.1%}"}))
@@ -250,11 +448,13 @@ if target_file and stock_file and history_file:
                     red_fmt = workbook.add_format(
                         {'bg_color': '#FFC7CE', 'font_color': '#9C0006'})
 
+                    # Only format the rows actually written
+                    ratio_range = f'H2:H{len(df_result) + 1}'
                     worksheet.set_column('H:H', None, percent_fmt)
                     worksheet.conditional_format(
-                        'H2:H100000', {'type': 'cell', 'criteria': '==', 'value': 1, 'format': green_fmt})
+                        ratio_range, {'type': 'cell', 'criteria': '==', 'value': 1, 'format': green_fmt})
                     worksheet.conditional_format(
-                        'H2:H100000', {'type': 'cell', 'criteria': '<', 'value': 1, 'format': red_fmt})
+                        ratio_range, {'type': 'cell', 'criteria': '<', 'value': 1, 'format': red_fmt})
 
                 buffer.seek(0)
                 st.download_button(